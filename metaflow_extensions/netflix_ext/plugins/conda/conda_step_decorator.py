@@ -1,18 +1,16 @@
 # pyright: strict, reportTypeCommentUsage=false, reportMissingTypeStubs=false
 
-import importlib
-import json
 import os
-import shutil
 import sys
-import tempfile
 
 from typing import (
+    TYPE_CHECKING,
     Any,
     Callable,
     Dict,
     List,
     Optional,
+    Tuple,
     Union,
     cast,
 )
@@ -31,11 +29,9 @@ from metaflow.metaflow_environment import (
     InvalidEnvironmentException,
     MetaflowEnvironment,
 )
-from metaflow.plugins.env_escape import generate_trampolines
 from metaflow.unbounded_foreach import UBF_CONTROL, UBF_TASK
 from metaflow.util import get_metaflow_root
 
-from .conda_environment import CondaEnvironment
 from .env_descr import EnvID
 from .utils import arch_id
 
@@ -46,7 +42,43 @@ from .conda_common_decorator import (
     PypiRequirementDecoratorMixin,
     SysPackagesRequirementDecoratorMixin,
 )
-from .conda import Conda
+
+if TYPE_CHECKING:
+    from .conda import Conda
+    from .conda_environment import CondaEnvironment
+
+
+def __getattr__(name: str) -> Any:
+    # Conda and CondaEnvironment used to be imported at the top of this module;
+    # they are now only loaded when needed but are still reachable from here.
+    if name == "Conda":
+        from .conda import Conda
+
+        return Conda
+    if name == "CondaEnvironment":
+        from .conda_environment import CondaEnvironment
+
+        return CondaEnvironment
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
+_REMOTE_COMMANDS = frozenset(CONDA_REMOTE_COMMANDS)
+# Set on first use in runtime_step_cli; the platform cannot change in a process
+_IS_LINUX = None  # type: Optional[bool]
+
+
+class _FetchParam:
+    # Lazily loads the value of a parameter from a datastore; used to resolve
+    # fetch-at-exec environment names that depend on parameter values
+    __slots__ = ("p", "v", "d")
+
+    def __init__(self, param: Any, var: str, ds: TaskDataStore):
+        self.p = param
+        self.v = var
+        self.d = ds
+
+    def __call__(self) -> str:
+        return str(self.p.load_parameter(self.d[self.v]))
 
 
 class PackageRequirementStepDecorator(StepDecorator):
@@ -356,6 +388,18 @@ class CondaEnvInternalDecorator(StepDecorator):
     conda = None  # type: Optional[Conda]
     _local_root = None  # type: Optional[str]
 
+    _metaflow_home = None  # type: Optional[str]
+    _metaflow_home_pid = None  # type: Optional[int]
+    _addl_paths = None  # type: Optional[List[str]]
+    # Everything (except trampolines) created in _metaflow_home; see
+    # _remove_metaflow_home
+    _created_paths = []  # type: List[str]
+    # Paths of EXT_PKG (None if it cannot be imported); see _get_ext_paths
+    _ext_paths = None  # type: Optional[List[str]]
+    _ext_paths_resolved = False
+    # (env var name, parameter name, parameter) for all parameters of the flow
+    _cached_params = None  # type: Optional[List[Tuple[str, str, Any]]]
+
     def step_init(
         self,
         flow: FlowSpec,
@@ -367,7 +411,7 @@ class CondaEnvInternalDecorator(StepDecorator):
         logger: Callable[..., None],
     ):
         self._echo = logger
-        self._env = cast(CondaEnvironment, environment)
+        self._env = cast("CondaEnvironment", environment)
         self._flow = flow
         self._step_name = step_name
         self._flow_datastore = flow_datastore
@@ -376,70 +420,24 @@ class CondaEnvInternalDecorator(StepDecorator):
         self._env_for_fetch = {}  # type: Dict[str, Union[str, Callable[[], str]]]
 
         self._env_id = None  # type: Optional[EnvID]
+        # Serialized version of _env_id passed to each task; see _set_env_id
+        self._env_id_json = None  # type: Optional[str]
+
+        # The step's configuration does not change once the environment is
+        # initialized so these are computed on first use (not here as the
+        # environment may not be initialized yet)
+        self._enabled_cache = {}  # type: Dict[str, bool]
+        self._fetch_at_exec = None  # type: Optional[bool]
 
-        self._is_remote = any([d.name in CONDA_REMOTE_COMMANDS for d in decorators])
+        self._is_remote = any(d.name in _REMOTE_COMMANDS for d in decorators)
 
         os.environ["PYTHONNOUSERSITE"] = "1"
 
     def runtime_init(self, flow: FlowSpec, graph: FlowGraph, package: Any, run_id: str):
-        # Create a symlink to installed version of metaflow to execute user code against
-        path_to_metaflow = os.path.join(get_metaflow_root(), "metaflow")
-        path_to_info = os.path.join(get_metaflow_root(), "INFO")
-        self._metaflow_home = tempfile.mkdtemp(dir="/tmp")
-        self._addl_paths = None  # type: Optional[List[str]]
-        os.symlink(path_to_metaflow, os.path.join(self._metaflow_home, "metaflow"))
-
-        # Symlink the INFO file as well to properly propagate down the Metaflow version
-        # if launching on AWS Batch for example
-        if os.path.isfile(path_to_info):
-            os.symlink(path_to_info, os.path.join(self._metaflow_home, "INFO"))
-        else:
-            # If there is no "INFO" file, we will actually create one in this new
-            # place because we won't be able to properly resolve the EXT_PKG extensions
-            # the same way as outside conda (looking at distributions, etc). In a
-            # Conda environment, as shown below (where we set self._addl_paths), all
-            # EXT_PKG extensions are PYTHONPATH extensions. Instead of re-resolving,
-            # we use the resolved information that is written out to the INFO file.
-            with open(
-                os.path.join(self._metaflow_home, "INFO"), mode="wt", encoding="utf-8"
-            ) as f:
-                f.write(
-                    json.dumps(self._env.get_environment_info(include_ext_info=True))
-                )
-
-        # Do the same for EXT_PKG
-        try:
-            m = importlib.import_module(EXT_PKG)
-        except ImportError:
-            # No additional check needed because if we are here, we already checked
-            # for other issues when loading at the toplevel
-            pass
-        else:
-            custom_paths = list(set(m.__path__))  # For some reason, at times, unique
-            # paths appear multiple times. We simplify
-            # to avoid un-necessary links
-
-            if len(custom_paths) == 1:
-                # Regular package; we take a quick shortcut here
-                os.symlink(
-                    custom_paths[0],
-                    os.path.join(self._metaflow_home, EXT_PKG),
-                )
-            else:
-                # This is a namespace package, we therefore create a bunch of directories
-                # so we can symlink in those separately and we will add those paths
-                # to the PYTHONPATH for the interpreter. Note that we don't symlink
-                # to the parent of the package because that could end up including
-                # more stuff we don't want
-                self._addl_paths = []
-                for p in custom_paths:
-                    temp_dir = tempfile.mkdtemp(dir=self._metaflow_home)
-                    os.symlink(p, os.path.join(temp_dir, EXT_PKG))
-                    self._addl_paths.append(temp_dir)
-
-        # Also install any environment escape overrides directly here to enable
-        # the escape to work even in non metaflow-created subprocesses
-        generate_trampolines(self._metaflow_home)
+        # The directory containing metaflow, INFO, EXT_PKG and the trampolines is
+        # the same for all steps so it is only prepared once per process and shared
+        if CondaEnvInternalDecorator._metaflow_home is None:
+            CondaEnvInternalDecorator._setup_metaflow_home(self._env)
 
         # If we need to fetch the environment on exec, save the information we need
         # so that we can resolve it using information such as run id, step name, task
@@ -466,27 +464,33 @@ class CondaEnvInternalDecorator(StepDecorator):
                 parent_ds = self._flow_datastore.get_task_datastore(
                     run_id, step_name, task_id
                 )
-                for var, _ in self._flow._get_parameters():
-                    self._env_for_fetch[
-                        "METAFLOW_INIT_%s" % var.upper().replace("-", "_")
-                    ] = lambda _param=getattr(
-                        self._flow, var
-                    ), _var=var, _ds=parent_ds: str(
-                        _param.load_parameter(_ds[_var])
-                    )
+                cls = CondaEnvInternalDecorator
+                if cls._cached_params is None:
+                    # Parameters are the same for all steps of the flow
+                    cls._cached_params = [
+                        (
+                            "METAFLOW_INIT_%s" % var.upper().replace("-", "_"),
+                            var,
+                            getattr(self._flow, var),
+                        )
+                        for var, _ in self._flow._get_parameters()
+                    ]
+                for env_name, var, param in cls._cached_params:
+                    self._env_for_fetch[env_name] = _FetchParam(param, var, parent_ds)
                 self._env_for_fetch["METAFLOW_TASK_ID"] = task_id
 
-                self._env_id = self._env.resolve_fetch_at_exec_env(
+                env_id = self._env.resolve_fetch_at_exec_env(
                     self._step_name, self._env_for_fetch
                 )
-                if self._env_id is None:
+                if env_id is None:
                     raise InvalidEnvironmentException(
                         "Cannot find the environment ID for a fetch-at-exec step"
                     )
+                self._set_env_id(env_id)
             else:
                 t = self._env.get_env_id_noconda(self._step_name)
                 if isinstance(t, EnvID):
-                    self._env_id = t
+                    self._set_env_id(t)
                 else:
                     raise InvalidEnvironmentException(
                         "Unexpected ID for the Conda environment for step '%s': '%s'"
@@ -500,6 +504,8 @@ class CondaEnvInternalDecorator(StepDecorator):
         max_user_code_retries: int,
         ubf_context: str,
     ):
+        import json
+
         # We also set the env var in remote case for is_fetch_at_exec
         # so that it can be used to fill out the bootstrap command with
         # the proper environment
@@ -515,7 +521,9 @@ class CondaEnvInternalDecorator(StepDecorator):
             # Note that in the case of a fetch_at_exec, self._env_id is fully resolved
             # (it was resolved in runtime_task_created) so this is the env_id we need
             # to use for our task.
-            cli_args.env["_METAFLOW_CONDA_ENV"] = json.dumps(self._env_id)
+            if self._env_id_json is None:
+                self._env_id_json = json.dumps(self._env_id)
+            cli_args.env["_METAFLOW_CONDA_ENV"] = self._env_id_json
 
             # If we are executing remotely, we now have _METAFLOW_CONDA_ENV set-up
             # properly so we will be able to use it in _get_env_id in conda_environment
@@ -525,7 +533,7 @@ class CondaEnvInternalDecorator(StepDecorator):
         else:
             return
 
-        conda = cast(Conda, self._env.conda)
+        conda = cast("Conda", self._env.conda)
         assert self._env_id
         entrypoint = None  # type: Optional[str]
         # Create the environment we are going to use
@@ -565,19 +573,18 @@ class CondaEnvInternalDecorator(StepDecorator):
             # created somehow
             raise InvalidEnvironmentException("No executable found for environment")
 
-        if arch_id().startswith("linux"):
+        global _IS_LINUX
+        if _IS_LINUX is None:
+            _IS_LINUX = arch_id().startswith("linux")
+        if _IS_LINUX:
             # No need for MacOS -- with SIP, DYLD_LIBRARY_PATH is ignored anyways
             old_ld_path = os.environ.get("LD_LIBRARY_PATH")
             if old_ld_path is not None:
                 cli_args.env["MF_ORIG_LD_LIBRARY_PATH"] = old_ld_path
-                cli_args.env["LD_LIBRARY_PATH"] = ":".join(
-                    [
-                        os.path.join(
-                            os.path.dirname(os.path.dirname(entrypoint)), "lib"
-                        ),
-                        old_ld_path,
-                    ]
-                )
+                # entrypoint is <env_prefix>/bin/python and separators are known
+                # on Linux so we can avoid the os.path calls
+                lib_path = entrypoint[: -len("/bin/python")] + "/lib"
+                cli_args.env["LD_LIBRARY_PATH"] = "%s:%s" % (lib_path, old_ld_path)
         cli_args.entrypoint[0] = entrypoint
 
     def task_pre_step(
@@ -599,8 +606,9 @@ class CondaEnvInternalDecorator(StepDecorator):
             # ensure that any non-pythonic dependencies introduced by the conda
             # environment are visible to the user code.
             env_path = os.path.dirname(os.path.realpath(sys.executable))
-            if os.environ.get("PATH") is not None:
-                env_path = os.pathsep.join([env_path, os.environ["PATH"]])
+            old_path = os.environ.get("PATH")
+            if old_path is not None:
+                env_path = env_path + os.pathsep + old_path
             os.environ["PATH"] = env_path
 
             metadata.register_metadata(
@@ -618,10 +626,154 @@ class CondaEnvInternalDecorator(StepDecorator):
             )
 
     def runtime_finished(self, exception: Exception):
-        shutil.rmtree(self._metaflow_home)
+        # Called once per step but the directory is shared so only the first
+        # call cleans up (and only if this process created it)
+        cls = CondaEnvInternalDecorator
+        if cls._metaflow_home is not None and cls._metaflow_home_pid == os.getpid():
+            cls._remove_metaflow_home()
+        cls._metaflow_home = None
+        cls._metaflow_home_pid = None
+        cls._addl_paths = None
+        cls._created_paths = []
+        cls._cached_params = None
+
+    @classmethod
+    def _get_ext_paths(cls) -> Optional[List[str]]:
+        # The paths of EXT_PKG cannot change during the lifetime of the process
+        if not cls._ext_paths_resolved:
+            import importlib
+
+            try:
+                m = importlib.import_module(EXT_PKG)
+            except ImportError:
+                # No additional check needed because if we are here, we already
+                # checked for other issues when loading at the toplevel
+                pass
+            else:
+                # For some reason, at times, unique paths appear multiple times.
+                # We simplify to avoid un-necessary links
+                cls._ext_paths = sorted(set(m.__path__))
+            cls._ext_paths_resolved = True
+        return cls._ext_paths
+
+    @classmethod
+    def _remove_metaflow_home(cls):
+        # We know what _setup_metaflow_home put in the directory (mostly symlinks)
+        # so we remove it directly instead of having rmtree walk and stat it.
+        home = cast(str, cls._metaflow_home)
+        try:
+            for p in cls._created_paths:
+                os.unlink(p)
+            for d in cls._addl_paths or []:
+                os.rmdir(d)
+            # What is left are the files written by generate_trampolines
+            with os.scandir(home) as it:
+                for entry in it:
+                    os.unlink(entry.path)
+            os.rmdir(home)
+        except OSError:
+            # Something else was added (a __pycache__ directory for example)
+            import shutil
+
+            shutil.rmtree(home)
+
+    @classmethod
+    def _setup_metaflow_home(cls, env: "CondaEnvironment"):
+        import json
+        import tempfile
+
+        # Create a symlink to installed version of metaflow to execute user code against
+        root = get_metaflow_root()
+        path_to_metaflow = os.path.join(root, "metaflow")
+        path_to_info = os.path.join(root, "INFO")
+
+        custom_paths = cls._get_ext_paths()
+
+        metaflow_home = tempfile.mkdtemp(prefix="metaflow-home-", dir="/tmp")
+        addl_paths = None  # type: Optional[List[str]]
+        created_paths = []  # type: List[str]
+
+        link = os.path.join(metaflow_home, "metaflow")
+        os.symlink(path_to_metaflow, link)
+        created_paths.append(link)
+
+        # Symlink the INFO file as well to properly propagate down the Metaflow version
+        # if launching on AWS Batch for example
+        info_dest = os.path.join(metaflow_home, "INFO")
+        if os.path.isfile(path_to_info):
+            os.symlink(path_to_info, info_dest)
+        else:
+            # If there is no "INFO" file, we will actually create one in this new
+            # place because we won't be able to properly resolve the EXT_PKG extensions
+            # the same way as outside conda (looking at distributions, etc). In a
+            # Conda environment, as shown below (where we set addl_paths), all
+            # EXT_PKG extensions are PYTHONPATH extensions. Instead of re-resolving,
+            # we use the resolved information that is written out to the INFO file.
+            info = json.dumps(env.get_environment_info(include_ext_info=True))
+            fd = os.open(info_dest, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+            try:
+                os.write(fd, info.encode("utf-8"))
+            finally:
+                os.close(fd)
+        created_paths.append(info_dest)
+
+        # Do the same for EXT_PKG
+        if custom_paths is not None:
+            if len(custom_paths) == 1:
+                # Regular package; we take a quick shortcut here
+                link = os.path.join(metaflow_home, EXT_PKG)
+                os.symlink(custom_paths[0], link)
+                created_paths.append(link)
+            else:
+                # This is a namespace package, we therefore create a bunch of directories
+                # so we can symlink in those separately and we will add those paths
+                # to the PYTHONPATH for the interpreter. Note that we don't symlink
+                # to the parent of the package because that could end up including
+                # more stuff we don't want
+                # The directories are numbered as metaflow_home is private to us
+                # so there is no need for mkdtemp's random names.
+                addl_paths = []
+                for idx, p in enumerate(custom_paths):
+                    ns_dir = os.path.join(metaflow_home, "_ns%d" % idx)
+                    os.mkdir(ns_dir)
+                    link = os.path.join(ns_dir, EXT_PKG)
+                    os.symlink(p, link)
+                    created_paths.append(link)
+                    addl_paths.append(ns_dir)
+
+        # Also install any environment escape overrides directly here to enable
+        # the escape to work even in non metaflow-created subprocesses
+        # Same check as generate_trampolines; doing it here means we don't even load
+        # the env_escape plugin when it would not write anything
+        if os.environ.get("METAFLOW_ENV_ESCAPE_DISABLED", False) not in (True, "True"):
+            from metaflow.plugins.env_escape import generate_trampolines
+
+            generate_trampolines(metaflow_home)
+
+        cls._metaflow_home = metaflow_home
+        cls._metaflow_home_pid = os.getpid()
+        cls._addl_paths = addl_paths
+        cls._created_paths = created_paths
+
+    def _set_env_id(self, env_id: EnvID):
+        if env_id != self._env_id:
+            self._env_id = env_id
+            self._env_id_json = None
 
     def _is_enabled(self, ubf_context: str = UBF_TASK) -> bool:
-        return CondaEnvironment.enabled_for_step(self._step_name, ubf_context)
+        enabled = self._enabled_cache.get(ubf_context)
+        if enabled is None:
+            from .conda_environment import CondaEnvironment
+
+            enabled = CondaEnvironment.enabled_for_step(self._step_name, ubf_context)
+            self._enabled_cache[ubf_context] = enabled
+        return enabled
 
     def _is_fetch_at_exec(self) -> bool:
-        return CondaEnvironment.fetch_at_exec_for_step(self._step_name)
+        if self._fetch_at_exec is None:
+            from .conda_environment import CondaEnvironment
+
+            self._fetch_at_exec = CondaEnvironment.fetch_at_exec_for_step(
+                self._step_name
+            )
+        return self._fetch_at_exec